@@ -1,24 +1,103 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 '''
 See dnsflow.c header comment for packet formats.
 '''
 
 import sys, time, argparse
-import socket
+import io, itertools, collections
+import multiprocessing, signal
+import socket, select, mmap
+import ctypes, ctypes.util
 import dpkt, pcap
 import struct
-import ipaddr
 
 DNSFLOW_FLAG_STATS = 0x0001
 DEFAULT_PCAP_FILTER = 'udp and dst port 5300'
+# Max pkts handed back by each pcap dispatch() call.
+PCAP_DISPATCH_BATCH = 256
+# Suggested reader read_buffer_size for large pcap files.
+LARGE_READ_BUFFER_SIZE = 128 * 1024
+# stdout buffer size for the command line tool when not writing to a tty.
+STDOUT_BUFFER_SIZE = 1 << 20
+# Batches of pkts queued per worker process when reader workers > 1.
+WORKER_BATCHES_IN_FLIGHT = 4
+# reader capture backends.
+BACKEND_PCAP = 'pcap'
+BACKEND_AF_PACKET_V3 = 'af_packet_v3'
+
+# Precompiled packet layouts. See dnsflow.c for the field definitions.
+# vers, sets_count, flags, seq_num
+HDR = struct.Struct('!BBHI')
+# pkts_captured, pkts_received, pkts_dropped, pkts_ifdropped, sample_rate
+STATS_V2 = struct.Struct('!5I')
+# pkts_captured, pkts_received, pkts_dropped, pkts_ifdropped
+STATS_V01 = struct.Struct('!4I')
+# client_ip, names_count, ips_count, names_len
+SET_HDR = struct.Struct('!IBBH')
+
+# Ethernet + IPv4 header fields needed to find the dnsflow payload:
+# eth type, ip vers/ihl, ip total len, ip frag off, ip proto, ip src
+ETH_IP_HDR = struct.Struct('!12xHBxHxxHxB2x4s')
+# udp sport
+UDP_SPORT = struct.Struct('!H')
+
+# ips_count -> Struct for that many ips. ips_count is a u8, so this stays small.
+_IPS_STRUCTS = {}
+
+# Names are raw bytes on the wire. latin-1 maps each byte to one character, so
+# decoding never fails or loses anything.
+NAME_ENCODING = 'latin-1'
+
+# Dotted quad strings for each octet value, for formatting ips.
+_OCTET = [str(i) for i in range(256)]
+
+# u32 ip -> dotted quad. Faster than inet_ntoa(struct.pack(...)) or building
+# ipaddress objects.
+def _u32_to_ip(addr, _octet=_OCTET):
+    return (f'{_octet[addr >> 24]}.{_octet[(addr >> 16) & 0xff]}'
+            f'.{_octet[(addr >> 8) & 0xff]}.{_octet[addr & 0xff]}')
+
+def _ips_struct(ips_count):
+    st = _IPS_STRUCTS.get(ips_count)
+    if st is None:
+        st = struct.Struct('!%dI' % (ips_count))
+        _IPS_STRUCTS[ips_count] = st
+    return st
+
+# Max entries in each _AddrCache.
+ADDR_CACHE_SIZE = 65536
+
+# Memoizes address -> string conversions. Captures usually have a few
+# thousand distinct srcs/clients at most, so a dict hit replaces formatting a
+# new string per pkt. Holds at most maxsize entries, evicting the oldest
+# first, so spoofed or very diverse captures can't grow it without bound.
+class _AddrCache(dict):
+    def __init__(self, to_str, maxsize=ADDR_CACHE_SIZE):
+        dict.__init__(self)
+        self._to_str = to_str
+        self._maxsize = maxsize
+        self._order = collections.deque()
+
+    def __missing__(self, addr):
+        addr_str = self._to_str(addr)
+        if len(self._order) >= self._maxsize:
+            del self[self._order.popleft()]
+        self[addr] = addr_str
+        self._order.append(addr)
+        return addr_str
+
+# Raw 4 byte ip src -> dotted quad.
+_SRC_IPS = _AddrCache(lambda addr: socket.inet_ntop(socket.AF_INET, addr))
+# u32 client_ip -> dotted quad.
+_CLIENT_IPS = _AddrCache(_u32_to_ip)
 
 # Utility functions to simplify interface.
 # E.g.
 # for dflow in flow_iter(interface='eth0'):
-#     print dflow
+#     print(dflow)
 # for dflow in flow_iter(pcap_file='dnsflow.pcap'):
-#     print dflow
+#     print(dflow)
 def flow_iter(**kwargs):
     rdr = reader(**kwargs)
     return rdr.flow_iter()
@@ -28,21 +107,58 @@ def pkt_iter(**kwargs):
 
 # Top-level interface for reading/capturing dnsflow. Instantiate object,
 # then iterate using flow_iter() or pkt_iter().
+# header_only - see process_pkt(). Data pkts from pkt_iter() may then be
+# header tuples; use SrcTracker.update_header() for those.
 class reader(object):
+    # read_buffer_size - for pcap_file only. If set, read the file through
+    # dpkt using a read buffer of this many bytes (e.g.,
+    # LARGE_READ_BUFFER_SIZE) instead of through libpcap's small stdio buffer.
+    # pcap_filter is NOT applied in this mode, so the file should only contain
+    # dnsflow pkts.
+    # backend - for interface only. BACKEND_PCAP captures with libpcap.
+    # BACKEND_AF_PACKET_V3 (linux only) reads whole blocks of pkts out of a
+    # TPACKET_V3 ring mmap'd from the kernel, see AfPacketRing.
+    # workers - if > 1, parse pkts in this many worker processes. Pkts are
+    # still returned in capture order.
     def __init__(self, interface=None, pcap_file=None,
-            pcap_filter=DEFAULT_PCAP_FILTER, stats_only=False):
+            pcap_filter=DEFAULT_PCAP_FILTER, stats_only=False,
+            read_buffer_size=None, header_only=False, backend=BACKEND_PCAP,
+            workers=1):
         if interface is None and pcap_file is None:
             raise Exception('Specify interface or pcap_file')
         if interface is not None and pcap_file is not None:
             raise Exception('Specify only interface or pcap_file')
+        if backend not in (BACKEND_PCAP, BACKEND_AF_PACKET_V3):
+            raise Exception('Unknown backend: %s' % (backend))
+        if backend != BACKEND_PCAP and interface is None:
+            raise Exception('backend %s needs an interface' % (backend))
 
         self.interface = interface
         self.pcap_file = pcap_file
         self.pcap_filter = pcap_filter
         self.stats_only = stats_only
+        self.header_only = header_only
+        self.read_buffer_size = read_buffer_size
+        self.backend = backend
+        self.workers = workers
 
-        self._pcap = pcap.pcapObject()
+        self._pcap = None
+        self._dpkt_reader = None
+        self._ring = None
+        # Pkts collected by _on_pkt during a dispatch() call.
+        self._batch = []
 
+        if self.pcap_file is not None and self.read_buffer_size is not None:
+            # No filter support, see above.
+            fd = io.open(pcap_file, 'rb', buffering=self.read_buffer_size)
+            self._dpkt_reader = dpkt.pcap.Reader(fd)
+            return
+
+        if self.backend == BACKEND_AF_PACKET_V3:
+            self._ring = AfPacketRing(interface, self.pcap_filter)
+            return
+
+        self._pcap = pcap.pcapObject()
         if self.pcap_file is not None:
             # XXX dpkt pcap doesn't support filters and there's no way to pass
             # a gzip fd to pylibpcap. Bummer.
@@ -55,8 +171,10 @@ class reader(object):
         self._pcap.setfilter(self.pcap_filter, 1, 0)
 
     # Iterate over individual dnsflow records (multiple per packet).
-    # Skips stats pkts.
+    # Skips stats pkts. Needs the full data pkts, so not with header_only.
     def flow_iter(self):
+        if self.header_only:
+            raise Exception('flow_iter needs full pkts, not header_only')
         for pkt in self.pkt_iter():
             ts = pkt['header']['timestamp']
             if 'data' not in pkt:
@@ -67,22 +185,449 @@ class reader(object):
 
     # Iterate over dnsflow pkts.
     def pkt_iter(self):
-        while 1:
-            rv = self._pcap.next()
-            if rv == None:
-                if self.pcap_file is not None:
-                    # eof
-                    break
-                else:
-                    # interface, hit to_ms
+        if self._dpkt_reader is not None:
+            dl_type = self._dpkt_reader.datalink()
+        elif self._ring is not None:
+            dl_type = dpkt.pcap.DLT_EN10MB
+        else:
+            dl_type = self._pcap.datalink()
+        if self.workers > 1:
+            results = self._worker_results(dl_type)
+        else:
+            results = (_process_batch((dl_type, self.stats_only,
+                self.header_only, batch)) for batch in self._pkt_batches())
+        for parsed in results:
+            for pkt, err in parsed:
+                if err is not None:
+                    print(err)
                     continue
-            pktlen, buf, ts = rv
-            pkt, err = process_pkt(self._pcap.datalink(), ts, buf,
-                    stats_only=self.stats_only)
-            if err is not None:
-                print err
+                yield pkt
+
+    # Parse batches in a pool of worker processes. Iterates over the
+    # _process_batch() results in the same order as the batches were
+    # captured. Results are passed on as soon as they're ready, so a quiet
+    # interface doesn't hold them back. At most WORKER_BATCHES_IN_FLIGHT
+    # batches per worker are queued at a time, so a fast pcap_file isn't read
+    # into memory ahead of the workers.
+    # On ctrl-c while waiting on the capture, the batches already queued are
+    # still parsed and passed on before the KeyboardInterrupt. If it's raised
+    # in the caller instead, those batches are dropped.
+    def _worker_results(self, dl_type):
+        pool = multiprocessing.Pool(self.workers, _worker_init)
+        pending = collections.deque()
+        max_pending = self.workers * WORKER_BATCHES_IN_FLIGHT
+        try:
+            try:
+                for batch in self._pkt_batches(idle=True):
+                    if batch:
+                        pending.append(pool.apply_async(_process_batch,
+                            ((dl_type, self.stats_only, self.header_only,
+                                batch),)))
+                    while pending and (pending[0].ready() or
+                            len(pending) >= max_pending):
+                        yield pending.popleft().get()
+            except KeyboardInterrupt:
+                # Workers ignore SIGINT, so they finish what's queued.
+                while pending:
+                    yield pending.popleft().get()
+                raise
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            pool.terminate()
+
+    # Iterate over lists of raw (pktlen, buf, ts) captured pkts. Pulls up to
+    # PCAP_DISPATCH_BATCH pkts per call into libpcap rather than one.
+    # idle - if set, an interface also gives an empty list each time it times
+    # out waiting for pkts.
+    def _pkt_batches(self, idle=False):
+        if self._dpkt_reader is not None:
+            for batch in self._dpkt_batches():
+                yield batch
+            return
+        if self._ring is not None:
+            for batch in self._ring.batches(idle):
+                yield batch
+            return
+        while 1:
+            self._batch = []
+            self._pcap.dispatch(PCAP_DISPATCH_BATCH, self._on_pkt)
+            if self._batch:
+                yield self._batch
+            elif self.pcap_file is not None:
+                # eof
+                break
+            elif idle:
+                # Interface, hit to_ms.
+                yield self._batch
+
+    # dispatch() callback.
+    def _on_pkt(self, pktlen, buf, ts):
+        self._batch.append((pktlen, buf, ts))
+
+    # _pkt_batches() for the dpkt reader.
+    def _dpkt_batches(self):
+        rdr = iter(self._dpkt_reader)
+        while 1:
+            batch = [(len(buf), buf, ts)
+                    for ts, buf in itertools.islice(rdr, PCAP_DISPATCH_BATCH)]
+            if not batch:
+                break
+            yield batch
+
+# linux <linux/if_packet.h>, <linux/if_ether.h>, <asm/socket.h>
+SOL_PACKET = 263
+PACKET_ADD_MEMBERSHIP = 1
+PACKET_MR_PROMISC = 1
+PACKET_RX_RING = 5
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+ETH_P_ALL = 0x0003
+PACKET_OUTGOING = 4
+ARPHRD_LOOPBACK = 772
+SO_ATTACH_FILTER = 26
+
+# struct tpacket_req3
+TPACKET_REQ3 = struct.Struct('=7I')
+# struct packet_mreq: mr_ifindex, mr_type, mr_alen, mr_address
+PACKET_MREQ = struct.Struct('=iHH8s')
+# tpacket_block_desc.hdr.bh1: block_status, num_pkts, offset_to_first_pkt
+TPACKET_BLOCK_HDR = struct.Struct('=III')
+# Offset of block_status in struct tpacket_block_desc.
+TPACKET_BLOCK_STATUS_OFF = 8
+# struct tpacket3_hdr: tp_next_offset, tp_sec, tp_nsec, tp_snaplen, tp_len,
+# tp_status, tp_mac
+TPACKET3_HDR = struct.Struct('=6IH')
+# The struct sockaddr_ll for the pkt follows the tpacket3_hdr, at
+# TPACKET_ALIGN(sizeof(struct tpacket3_hdr)). sll_pkttype is byte 10 of it.
+TPACKET3_SLL_PKTTYPE_OFF = 48 + 10
+
+# struct bpf_insn, struct bpf_program from <pcap/bpf.h>.
+class _BpfInsn(ctypes.Structure):
+    _fields_ = [('code', ctypes.c_ushort), ('jt', ctypes.c_ubyte),
+            ('jf', ctypes.c_ubyte), ('k', ctypes.c_uint32)]
+
+class _BpfProgram(ctypes.Structure):
+    _fields_ = [('bf_len', ctypes.c_uint),
+            ('bf_insns', ctypes.POINTER(_BpfInsn))]
+
+# Compile pcap_filter for ethernet with libpcap (loaded through ctypes, as
+# pylibpcap doesn't export the compiled program). Returns the raw array of
+# struct sock_filter, which has the same layout as struct bpf_insn, and the
+# number of instructions.
+def _compile_bpf(pcap_filter, snaplen=65535):
+    libpcap_name = ctypes.util.find_library('pcap')
+    if libpcap_name is None:
+        raise Exception('libpcap not found, needed to compile filter')
+    libpcap = ctypes.CDLL(libpcap_name)
+    libpcap.pcap_open_dead.restype = ctypes.c_void_p
+    libpcap.pcap_open_dead.argtypes = [ctypes.c_int, ctypes.c_int]
+    libpcap.pcap_compile.argtypes = [ctypes.c_void_p,
+            ctypes.POINTER(_BpfProgram), ctypes.c_char_p, ctypes.c_int,
+            ctypes.c_uint32]
+    libpcap.pcap_geterr.restype = ctypes.c_char_p
+    libpcap.pcap_geterr.argtypes = [ctypes.c_void_p]
+    libpcap.pcap_freecode.argtypes = [ctypes.POINTER(_BpfProgram)]
+    libpcap.pcap_close.argtypes = [ctypes.c_void_p]
+
+    p = libpcap.pcap_open_dead(dpkt.pcap.DLT_EN10MB, snaplen)
+    if not p:
+        raise Exception('pcap_open_dead failed')
+    try:
+        prog = _BpfProgram()
+        # filter, optimize, netmask (PCAP_NETMASK_UNKNOWN)
+        if libpcap.pcap_compile(p, ctypes.byref(prog),
+                pcap_filter.encode('ascii'), 1, 0xffffffff) != 0:
+            raise Exception('Bad filter "%s": %s' % (pcap_filter,
+                libpcap.pcap_geterr(p).decode('ascii', 'replace')))
+        insns = ctypes.string_at(prog.bf_insns,
+                prog.bf_len * ctypes.sizeof(_BpfInsn))
+        n_insns = prog.bf_len
+        libpcap.pcap_freecode(ctypes.byref(prog))
+    finally:
+        libpcap.pcap_close(p)
+    return (insns, n_insns)
+
+# Live capture from a linux AF_PACKET socket with a TPACKET_V3 rx ring. The
+# kernel fills whole blocks of pkts in memory shared with us, so there's one
+# poll() per block rather than a read per pkt, and blocks are handed back to
+# the kernel for reuse as soon as their pkts have been copied out.
+class AfPacketRing(object):
+    def __init__(self, interface, pcap_filter=DEFAULT_PCAP_FILTER,
+            block_size=1 << 22, block_nr=8, frame_size=1 << 16,
+            retire_blk_tov=100, promisc=True):
+        if not hasattr(socket, 'AF_PACKET'):
+            raise Exception('AF_PACKET is only supported on linux')
+        self.interface = interface
+        self.pcap_filter = pcap_filter
+        self.block_size = block_size
+        self.block_nr = block_nr
+        # ms before the kernel hands over a partially filled block. Also used
+        # as the poll() timeout, like to_ms for libpcap.
+        self.retire_blk_tov = retire_blk_tov
+
+        # Protocol 0 receives nothing until the bind() below, so no pkts
+        # (from any interface) land in the ring before the filter is set.
+        self._sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+        if pcap_filter:
+            insns, n_insns = _compile_bpf(pcap_filter)
+            filt = ctypes.create_string_buffer(insns, len(insns))
+            # struct sock_fprog
+            fprog = struct.pack('HP', n_insns, ctypes.addressof(filt))
+            self._sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+        self._sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+        # block_size, block_nr, frame_size, frame_nr, retire_blk_tov,
+        # sizeof_priv, feature_req_word
+        req = TPACKET_REQ3.pack(block_size, block_nr, frame_size,
+                (block_size // frame_size) * block_nr, retire_blk_tov, 0, 0)
+        self._sock.setsockopt(SOL_PACKET, PACKET_RX_RING, req)
+        self._ring = mmap.mmap(self._sock.fileno(), block_size * block_nr,
+                mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        self._sock.bind((interface, ETH_P_ALL))
+        # On loopback each pkt is seen twice, once going out and once coming
+        # in. Like libpcap, only keep the incoming copy.
+        self._skip_outgoing = self._sock.getsockname()[3] == ARPHRD_LOOPBACK
+        if promisc:
+            # As for libpcap's open_live(). Dropped when the socket is closed.
+            mreq = PACKET_MREQ.pack(socket.if_nametoindex(interface),
+                    PACKET_MR_PROMISC, 0, b'')
+            self._sock.setsockopt(SOL_PACKET, PACKET_ADD_MEMBERSHIP, mreq)
+        self._poll = select.poll()
+        self._poll.register(self._sock.fileno(),
+                select.POLLIN | select.POLLERR)
+
+    # Iterate over lists of raw (pktlen, buf, ts) captured pkts, one list per
+    # ring block.
+    # idle - if set, also give an empty list each time the wait for a block
+    # times out.
+    def batches(self, idle=False):
+        ring = self._ring
+        skip_outgoing = self._skip_outgoing
+        blk = 0
+        while 1:
+            blk_off = blk * self.block_size
+            status, num_pkts, first_off = \
+                    TPACKET_BLOCK_HDR.unpack_from(ring,
+                        blk_off + TPACKET_BLOCK_STATUS_OFF)
+            if not status & TP_STATUS_USER:
+                # Block still owned by the kernel.
+                if not self._poll.poll(self.retire_blk_tov) and idle:
+                    yield []
                 continue
-            yield pkt
+            batch = []
+            cp = blk_off + first_off
+            for _ in range(num_pkts):
+                next_off, sec, nsec, snaplen, pktlen, pkt_status, mac = \
+                        TPACKET3_HDR.unpack_from(ring, cp)
+                if (not skip_outgoing or
+                        ring[cp + TPACKET3_SLL_PKTTYPE_OFF] != PACKET_OUTGOING):
+                    buf = ring[cp + mac:cp + mac + snaplen]
+                    batch.append((pktlen, buf, sec + nsec * 1e-9))
+                cp += next_off
+            # Return the block to the kernel.
+            struct.pack_into('=I', ring, blk_off + TPACKET_BLOCK_STATUS_OFF,
+                    TP_STATUS_KERNEL)
+            blk = (blk + 1) % self.block_nr
+            yield batch
+
+    def close(self):
+        self._ring.close()
+        self._sock.close()
+
+# Parse a batch of raw pkts. Takes a single tuple(dl_type, stats_only,
+# header_only, batch), where batch is a list of (pktlen, buf, ts), and returns
+# a list of process_pkt() results. Module level so worker processes can run
+# it.
+def _process_batch(args):
+    dl_type, stats_only, header_only, batch = args
+    return [process_pkt(dl_type, ts, buf, stats_only=stats_only,
+            header_only=header_only) for pktlen, buf, ts in batch]
+
+# Worker processes leave ctrl-c to the parent, which shuts the pool down.
+def _worker_init():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+# Parse names_count names from a vers 1/2 name_set.
+# Each name is in the form of an uncompressed dns name. names are root domain
+# (Nul) terminated, and padded with Nuls on the end to word align.
+# Raises IndexError if the names run off the end of name_set.
+# The labels are already in place in name_set, so copy it once into a scratch
+# buffer and overwrite the length bytes inside each name with '.'; each name is
+# then a single slice to decode.
+def _parse_names(name_set, names_count):
+    names = []
+    append = names.append
+    scratch = bytearray(name_set)
+    np = 0
+    for _ in range(names_count):
+        label_len = name_set[np]
+        start = np + 1
+        if label_len == 0:
+            # Root.
+            append('')
+            np = start
+            continue
+        while label_len != 0:
+            np += label_len + 1
+            label_len = name_set[np]
+            scratch[np] = 46 # '.'
+        # The last '.' lands on the terminating Nul, which is left out.
+        append(scratch[start:np].decode(NAME_ENCODING))
+        np += 1
+    return names
+
+STATS_FIELDS = ('pkts_captured', 'pkts_received', 'pkts_dropped',
+        'pkts_ifdropped', 'sample_rate')
+
+# Parse the body of a stats pkt laid out as st, from offset cp up to end.
+# Returns a tuple(stats_dict, error_string).
+def _parse_stats(dnsflow_pkt, cp, end, st):
+    if cp + st.size > end:
+        err = 'HEADER_PARSE_ERROR|%s|truncated, %d bytes left' % (st.format,
+                end - cp)
+        return (None, err)
+    stats = st.unpack_from(dnsflow_pkt, cp)
+    return (dict(zip(STATS_FIELDS, stats)), None)
+
+# Parse the sets_count data sets of a data pkt starting at offset cp.
+# wire_names - True for vers 1/2 dns wire format names, False for vers 0 Nul
+# separated names.
+# Returns a tuple(data_list, error_string). On error, data_list holds the sets
+# parsed so far.
+def _parse_data(sets_count, dnsflow_pkt, cp, end, wire_names):
+    data_list = []
+    # Locals for the per-set loop.
+    append = data_list.append
+    set_hdr_unpack = SET_HDR.unpack_from
+    set_hdr_size = SET_HDR.size
+    client_ips = _CLIENT_IPS
+    ips_structs = _IPS_STRUCTS
+    octet = _OCTET
+    for _ in range(sets_count):
+        if cp + set_hdr_size > end:
+            err = 'DATA_PARSE_ERROR|%s|truncated, %d bytes left' % (
+                    SET_HDR.format, end - cp)
+            return (data_list, err)
+        client_ip, names_count, ips_count, names_len = \
+                set_hdr_unpack(dnsflow_pkt, cp)
+        client_ip = client_ips[client_ip]
+        cp += set_hdr_size
+
+        names_end = cp + names_len
+        if names_end > end:
+            err = 'DATA_PARSE_ERROR|%ds|name_set runs past end of pkt' % (
+                    names_len)
+            return (data_list, err)
+        name_set = dnsflow_pkt[cp:names_end]
+        cp = names_end
+        if wire_names:
+            try:
+                names = _parse_names(name_set, names_count)
+            except IndexError as e:
+                # Hit the end of the name_set buffer.
+                err = 'NAMES_PARSE_ERROR|%s|%d|%s' % (repr(name_set),
+                        names_count, e)
+                return (data_list, err)
+        else:
+            # vers = 0
+            # names are Nul terminated, and padded with Nuls on the end to
+            # word align.
+            names = [name.decode(NAME_ENCODING)
+                    for name in name_set.split(b'\0')[0:names_count]]
+
+        st = ips_structs.get(ips_count)
+        if st is None:
+            st = _ips_struct(ips_count)
+        if cp + st.size > end:
+            err = 'DATA_PARSE_ERROR|%s|truncated, %d bytes left' % (
+                    st.format, end - cp)
+            return (data_list, err)
+        ips = st.unpack_from(dnsflow_pkt, cp)
+        cp += st.size
+        # _u32_to_ip, inlined.
+        ips = [f'{octet[x >> 24]}.{octet[(x >> 16) & 0xff]}'
+                f'.{octet[(x >> 8) & 0xff]}.{octet[x & 0xff]}' for x in ips]
+
+        append({'client_ip': client_ip, 'names': names, 'ips': ips})
+
+    return (data_list, None)
+
+# Per-version parsers for the body of a pkt, which runs from offset cp up to
+# end of dnsflow_pkt. All return a tuple(body, error_string).
+def _parse_v01_stats(sets_count, dnsflow_pkt, cp, end):
+    return _parse_stats(dnsflow_pkt, cp, end, STATS_V01)
+
+def _parse_v2_stats(sets_count, dnsflow_pkt, cp, end):
+    return _parse_stats(dnsflow_pkt, cp, end, STATS_V2)
+
+def _parse_v0_data(sets_count, dnsflow_pkt, cp, end):
+    return _parse_data(sets_count, dnsflow_pkt, cp, end, False)
+
+def _parse_v12_data(sets_count, dnsflow_pkt, cp, end):
+    return _parse_data(sets_count, dnsflow_pkt, cp, end, True)
+
+# (vers, is stats pkt) -> (pkt key, body parser). Covers every vers that
+# _is_dnsflow_candidate() lets through.
+_PARSERS = {
+    (0, True): ('stats', _parse_v01_stats),
+    (1, True): ('stats', _parse_v01_stats),
+    (2, True): ('stats', _parse_v2_stats),
+    (0, False): ('data', _parse_v0_data),
+    (1, False): ('data', _parse_v12_data),
+    (2, False): ('data', _parse_v12_data),
+}
+
+# Fast path for the common Ethernet/IPv4/UDP frame: locate the udp header
+# at fixed offsets rather than building dpkt objects. Returns a
+# tuple(udp_offset, ip_end, ip_src), where ip_end is the offset just past the
+# ip payload and ip_src is the raw 4 byte src addr. Returns None if buf isn't
+# an unfragmented IPv4/UDP frame, in which case the caller should fall back
+# to dpkt.
+def _eth_ipv4_udp(buf):
+    if len(buf) < ETH_IP_HDR.size:
+        return None
+    eth_type, ver_ihl, ip_len, ip_off, ip_p, ip_src = \
+            ETH_IP_HDR.unpack_from(buf)
+    if (eth_type != dpkt.ethernet.ETH_TYPE_IP or ver_ihl >> 4 != 4 or
+            ip_p != dpkt.ip.IP_PROTO_UDP or ip_off & 0x3fff):
+        return None
+    ihl = (ver_ihl & 0xf) * 4
+    udp_off = 14 + ihl
+    if ihl < 20 or len(buf) < udp_off + 8:
+        return None
+    # Like dpkt, trim any ethernet padding using the ip total length. The
+    # capture may also have been cut short by the snaplen.
+    ip_end = len(buf)
+    if ip_len and 14 + ip_len < ip_end:
+        ip_end = 14 + ip_len
+    return (udp_off, ip_end, ip_src)
+
+# Quick check that the udp payload from cp to end could be a dnsflow pkt: room
+# for a header, a known version and at least one set. Used to reject other
+# traffic before doing any real parsing.
+def _is_dnsflow_candidate(udp_payload, cp, end):
+    return (end - cp >= HDR.size and udp_payload[cp] <= 2 and
+            udp_payload[cp + 1] != 0)
+
+# header_only fast path of process_pkt for ethernet data pkts. Returns a
+# tuple(src_ip_bytes, src_port, timestamp, vers, sets_count, flags, seq_num),
+# or None if the pkt needs the full parse: not a plain IPv4/UDP frame, a
+# stats pkt, or a bad header (so process_pkt can report the error).
+def _header_only(ts, buf):
+    rv = _eth_ipv4_udp(buf)
+    if rv is None:
+        return None
+    udp_off, ip_end, ip_src = rv
+    cp = udp_off + 8
+    if not _is_dnsflow_candidate(buf, cp, ip_end):
+        return None
+    vers, sets_count, flags, seq_num = HDR.unpack_from(buf, cp)
+    if flags & DNSFLOW_FLAG_STATS:
+        return None
+    src_port = UDP_SPORT.unpack_from(buf, udp_off)[0]
+    return (ip_src, src_port, ts, vers, sets_count, flags, seq_num)
 
 #
 # Returns a tuple(pkt_contents, error_string).
@@ -91,7 +636,17 @@ class reader(object):
 # pkt_contents is a dict containing the unmarshaled data from the packet. It
 # may be incomplete or empty on error.
 # stats_only - set to True to parse stats pkts and headers only of data pkts.
-def process_pkt(dl_type, ts, buf, stats_only=False):
+# header_only - set to True to return ethernet data pkts as the bare header
+# tuple from _header_only() instead of a dict. Other pkts are parsed as for
+# stats_only.
+def process_pkt(dl_type, ts, buf, stats_only=False, header_only=False):
+    if header_only:
+        if dl_type == dpkt.pcap.DLT_EN10MB:
+            hdr = _header_only(ts, buf)
+            if hdr is not None:
+                return (hdr, None)
+        stats_only = True
+
     pkt = {}
     err = None
 
@@ -108,41 +663,51 @@ def process_pkt(dl_type, ts, buf, stats_only=False):
             ip_pkt = None
             src_ip = '0.0.0.0'
             src_port = 0
+            cp = 0
+            end = len(dnsflow_pkt)
         elif lo.family == socket.AF_INET:
             # dl, ip, udp, dnsflow_pkt
             dnsflow_pkt = lo.data.data.data
             ip_pkt = lo.data
-            src_ip = socket.inet_ntop(socket.AF_INET, ip_pkt.src)
+            src_ip = _SRC_IPS[ip_pkt.src]
             src_port = ip_pkt.data.sport
+            cp = 0
+            end = len(dnsflow_pkt)
     elif dl_type == dpkt.pcap.DLT_EN10MB:
         # Ethernet
-        try:
-            eth = dpkt.ethernet.Ethernet(buf)
-        except:
-            err = 'ETHERNET-PARSE-FAILED|%s' % (buf)
-            return (pkt, err)
-        dnsflow_pkt = eth.data.data.data
-        ip_pkt = eth.data
-        src_ip = socket.inet_ntop(socket.AF_INET, ip_pkt.src)
-        src_port = ip_pkt.data.sport
-
-    cp = 0
+        rv = _eth_ipv4_udp(buf)
+        if rv is not None:
+            udp_off, ip_end, ip_src = rv
+            # Parse the dnsflow pkt in place rather than copying it out.
+            dnsflow_pkt = buf
+            cp = udp_off + 8
+            end = ip_end
+            src_ip = _SRC_IPS[ip_src]
+            src_port = UDP_SPORT.unpack_from(buf, udp_off)[0]
+        else:
+            # Not a plain IPv4/UDP frame (vlan tag, fragment, runt, ...).
+            # Let dpkt sort it out.
+            try:
+                eth = dpkt.ethernet.Ethernet(buf)
+            except:
+                err = 'ETHERNET-PARSE-FAILED|%s' % (buf)
+                return (pkt, err)
+            dnsflow_pkt = eth.data.data.data
+            ip_pkt = eth.data
+            src_ip = _SRC_IPS[ip_pkt.src]
+            src_port = ip_pkt.data.sport
+            cp = 0
+            end = len(dnsflow_pkt)
 
-    # vers, sets_count, flags, seq_num
-    fmt = '!BBHI'
-    try:
-        vers, sets_count, flags, seq_num = struct.unpack(fmt,
-                dnsflow_pkt[cp:cp + struct.calcsize(fmt)])
-    except struct.error, e:
-        err = 'PARSE_ERROR|%s|%s' % (fmt, e)
+    if not _is_dnsflow_candidate(dnsflow_pkt, cp, end):
+        # Something else got past the pcap filter.
+        err = 'NOT_DNSFLOW|%s' % (src_ip)
         return (pkt, err)
-    cp += struct.calcsize(fmt)
+    vers, sets_count, flags, seq_num = HDR.unpack_from(dnsflow_pkt, cp)
+    cp += HDR.size
+
+    is_stats = (flags & DNSFLOW_FLAG_STATS) != 0
 
-    # Version 0, 1, or 2
-    if (vers != 0 and vers != 1 and vers !=2) or sets_count == 0:
-        err = 'BAD_PKT|%s' % (src_ip)
-        return (pkt, err)
-   
     hdr = {}
     hdr['src_ip'] = src_ip
     hdr['src_port'] = src_port
@@ -152,104 +717,21 @@ def process_pkt(dl_type, ts, buf, stats_only=False):
     hdr['sequence_number'] = seq_num
     pkt['header'] = hdr
     
-    if flags & DNSFLOW_FLAG_STATS:
-        if vers == 2:
-            fmt = '!5I'
-        else:
-            # vers 0 or 1
-            fmt = '!4I'
-        try:
-            stats = struct.unpack(fmt,
-                    dnsflow_pkt[cp:cp + struct.calcsize(fmt)])
-        except struct.error, e:
-            err = 'HEADER_PARSE_ERROR|%s|%s' % (fmt, e)
-            return (pkt, err)
-        sp = {}
-        sp['pkts_captured'] = stats[0]
-        sp['pkts_received'] = stats[1]
-        sp['pkts_dropped'] = stats[2]
-        sp['pkts_ifdropped'] = stats[3]
-        if vers == 2:
-            sp['sample_rate'] = stats[4]
-        pkt['stats'] = sp
-
-    elif not stats_only:
-        # data pkt
-        pkt['data'] = []
-        for i in range(sets_count):
-            # client_ip, names_count, ips_count, names_len
-            fmt = '!IBBH'
-            try:
-                vals = struct.unpack(fmt,
-                        dnsflow_pkt[cp:cp + struct.calcsize(fmt)])
-                client_ip, names_count, ips_count, names_len = vals
-            except struct.error, e:
-                err = 'DATA_PARSE_ERROR|%s|%s' % (fmt, e)
-                return (pkt, err)
-            cp += struct.calcsize(fmt)
-            client_ip = str(ipaddr.IPAddress(client_ip))
-
-            fmt = '%ds' % (names_len)
-
-            try:
-                name_set = struct.unpack(fmt,
-                        dnsflow_pkt[cp:cp + struct.calcsize(fmt)])[0]
-            except struct.error, e:
-                err = 'DATA_PARSE_ERROR|%s|%s' % (fmt, e)
-                return (pkt, err)
-            cp += struct.calcsize(fmt)
-            if vers == 1 or vers == 2:
-                # Each name is in the form of an uncompressed dns name.
-                # names are root domain (Nul) terminated, and padded with Nuls
-                # on the end to word align. 
-                names = []
-                np = 0
-                try:
-                    for x in range(names_count):
-                        name = []
-                        label_len = ord(name_set[np])
-                        np += 1
-                        while label_len != 0:
-                            name.append(name_set[np: np + label_len])
-                            np += label_len
-                            label_len = ord(name_set[np])
-                            np += 1
-                        name = '.'.join(name)
-                        names.append(name)
-                except IndexError as e:
-                    # Hit the end of the name_set buffer.
-                    err = 'NAMES_PARSE_ERROR|%s|%d|%s' % (repr(name_set),
-                            names_count, e)
-                    return (pkt, err)
-            else:
-                # vers = 0
-                # names are Nul terminated, and padded with Nuls on the end to
-                # word align.
-                names = name_set.split('\0')
-                names = names[0:names_count]
-
-            fmt = '!%dI' % (ips_count)
-            try:
-                ips = struct.unpack(fmt,
-                        dnsflow_pkt[cp:cp + struct.calcsize(fmt)])
-            except struct.error, e:
-                err = 'DATA_PARSE_ERROR|%s|%s' % (fmt, e)
-                return (pkt, err)
-            cp += struct.calcsize(fmt)
-            ips = [str(ipaddr.IPAddress(x)) for x in ips]
-
-            data = {}
-            data['client_ip'] = client_ip
-            data['names'] = names
-            data['ips'] = ips
-            pkt['data'].append(data)
+    # stats_only skips the body of data pkts. Data pkts in the default mode
+    # are the common case, so test for them first.
+    if not stats_only or is_stats:
+        # vers was checked by _is_dnsflow_candidate().
+        key, parse = _PARSERS[(vers, is_stats)]
+        body, err = parse(sets_count, dnsflow_pkt, cp, end)
+        if body is not None:
+            pkt[key] = body
 
     return (pkt, err)
 
 # Deprecated.
 def read_pcapfiles(pcap_files, pcap_filter, callback):
     for pcap_file in pcap_files:
-        print 'FILE|%s' % (pcap_file)
+        print('FILE|%s' % (pcap_file))
         # XXX dpkt pcap doesn't support filters and there's no way to pass
         # a gzip fd to pylibpcap. Bummer.
         p = pcap.pcapObject()
@@ -266,13 +748,13 @@ def read_pcapfiles(pcap_files, pcap_filter, callback):
             pktlen, buf, ts = rv
             pkt, err = process_pkt(p.datalink(), ts, buf)
             if err is not None:
-                print err
+                print(err)
                 continue
             callback(pkt)
 
 # Deprecated.
 def mode_livecapture(interface, pcap_filter, callback):
-    print 'Capturing on', interface
+    print('Capturing on', interface)
     p = pcap.pcapObject()
     p.open_live(interface, 65535, 1, 100)
     # filter, optimize, netmask
@@ -285,117 +767,169 @@ def mode_livecapture(interface, pcap_filter, callback):
                 pktlen, buf, ts = rv
                 pkt, err = process_pkt(p.datalink(), ts, buf)
                 if err is not None:
-                    print err
+                    print(err)
                     continue
                 callback(pkt)
 
     except KeyboardInterrupt:
-        print '\nshutting down'
-        print '%d packets received, %d packets dropped, %d packets dropped by interface' % p.stats()
+        print('\nshutting down')
+        print('%d packets received, %d packets dropped, %d packets dropped by interface' % p.stats())
 
 def _print_parsed_pkt(pkt):
     hdr = pkt['header']
     ts = hdr['timestamp']
     tstr = time.strftime('%H:%M:%S', time.gmtime(ts))
 
-    print 'HEADER|src=%s:%d|ts=%s|n_sets=%d|flags=%d|seq=%d' % (hdr['src_ip'],
-            hdr['src_port'], tstr, hdr['sets_count'], hdr['flags'],
-            hdr['sequence_number'])
+    lines = [f"HEADER|src={hdr['src_ip']}:{hdr['src_port']}|ts={tstr}"
+            f"|n_sets={hdr['sets_count']}|flags={hdr['flags']}"
+            f"|seq={hdr['sequence_number']}"]
 
-    if 'stats' in pkt:
-        stats = pkt['stats']
-        print "STATS|%s" % ('|'.join(['%s:%d' % (x[0], x[1])
-            for x in stats.items()]))
-    else:
+    # Data pkts first, they're the common case.
+    if 'stats' not in pkt:
         for data in pkt['data']:
-            print 'DATA|%s|%s|%s|%s' % (data['client_ip'], tstr,
-                    ','.join(data['names']), ','.join(data['ips']))
+            lines.append('DATA|%s|%s|%s|%s' % (data['client_ip'], tstr,
+                    ','.join(data['names']), ','.join(data['ips'])))
+    else:
+        stats = pkt['stats']
+        lines.append('STATS|%s' % ('|'.join('%s:%d' % x
+            for x in stats.items())))
 
+    # One write per pkt.
+    lines.append('')
+    sys.stdout.write('\n'.join(lines))
+
+
+# dnsflow sequence numbers are u32 and wrap.
+SEQ_MASK = 0xffffffff
+# Forward seq deltas below this are gaps, anything else is a step back.
+SEQ_HALF = 0x80000000
+
+# Per-source counters kept by SrcTracker.
+class SrcRec(object):
+    __slots__ = ('n_records', 'n_data_pkts', 'n_stats_pkts',
+            'first_timestamp', 'last_timestamp',
+            'seq_last', 'seq_total', 'seq_lost', 'seq_ooo',
+            'stats_last', 'stats_delta_last', 'stats_delta_total')
+
+    def __init__(self, timestamp, seq_num):
+        self.n_records = 0
+        self.n_data_pkts = 0
+        self.n_stats_pkts = 0
+        self.first_timestamp = timestamp
+        self.last_timestamp = timestamp
+        # As if the pkt before the first one had been seen, so the first
+        # pkt needs no special case in SrcTracker._update_seq().
+        self.seq_last = (seq_num - 1) & SEQ_MASK
+        self.seq_total = 0
+        self.seq_lost = 0
+        self.seq_ooo = 0
+        # Set on the first stats pkt.
+        self.stats_last = None
+        self.stats_delta_last = None
+        self.stats_delta_total = None
 
 class SrcTracker(object):
     def __init__(self):
         self.srcs = {}
+        # (raw src addr, src port) -> (src_id, SrcRec), for update_header().
+        self._raw_srcs = {}
 
-    def update(self, pkt):
-        hdr = pkt['header']
-        src_id = (hdr['src_ip'], hdr['src_port'])
+    def _src(self, src_id, timestamp, seq_num):
         src = self.srcs.get(src_id)
         if src is None:
-            src = {
-                    'n_records': 0,
-                    'n_data_pkts': 0,
-                    'n_stats_pkts': 0,
-                    'first_timestamp': hdr['timestamp'],
-                    'seq': {
-                        'seq_last': None,
-                        'seq_total': 0,
-                        'seq_lost': 0,
-                        'seq_ooo': 0,
-                        }
-                    }
+            src = SrcRec(timestamp, seq_num)
             self.srcs[src_id] = src
-        src['last_timestamp'] = hdr['timestamp']
-        if 'stats' in pkt:
-            src['n_stats_pkts'] += 1
-            if 'stats_last' not in src:
+        src.last_timestamp = timestamp
+        return src
+
+    def update(self, pkt):
+        hdr = pkt['header']
+        src_id = (hdr['src_ip'], hdr['src_port'])
+        src = self._src(src_id, hdr['timestamp'], hdr['sequence_number'])
+        # Data pkts first, they're the common case.
+        if 'stats' not in pkt:
+            src.n_data_pkts += 1
+            src.n_records += hdr['sets_count']
+        else:
+            stats = pkt['stats']
+            src.n_stats_pkts += 1
+            if src.stats_last is None:
                 # First stats for src
-                src['stats_last'] = pkt['stats']
-                src['stats_delta_last'] = {}
-                src['stats_delta_total'] = {}
-                for k in pkt['stats'].iterkeys():
+                src.stats_last = stats
+                src.stats_delta_last = {}
+                src.stats_delta_total = {}
+                for k in stats:
                     if k == 'sample_rate':
                         continue
-                    src['stats_delta_total'][k] = 0
-            for k in pkt['stats'].iterkeys():
+                    src.stats_delta_total[k] = 0
+            stats_last = src.stats_last
+            delta_last = src.stats_delta_last
+            delta_total = src.stats_delta_total
+            for k in stats:
                 if k == 'sample_rate':
                     continue
-                src['stats_delta_last'][k] = pkt['stats'][k] - src['stats_last'][k]
-                src['stats_delta_total'][k] += src['stats_delta_last'][k]
-            src['stats_last'] = pkt['stats']
-        else:
-            src['n_data_pkts'] += 1
-            src['n_records'] += hdr['sets_count']
-
-        # Track lost packets. Won't work if there are duplicates.
-        src_seq = src['seq']
-        src_seq['seq_total'] += 1
-        seq_num = hdr['sequence_number']
-        if src_seq['seq_last'] is None:
-            src_seq['seq_last'] = seq_num
-        elif seq_num == src_seq['seq_last'] + 1:
-            src_seq['seq_last'] = seq_num
-        elif seq_num > src_seq['seq_last'] + 1:
-            src_seq['seq_lost'] += seq_num - src_seq['seq_last'] - 1
-            src_seq['seq_last'] = seq_num
-        elif seq_num < src_seq['seq_last']:
-            src_seq['seq_lost'] -= 1
-            src_seq['seq_ooo'] += 1
-            # Don't update seq_last.
+                delta_last[k] = stats[k] - stats_last[k]
+                delta_total[k] += delta_last[k]
+            src.stats_last = stats
+
+        self._update_seq(src, hdr['sequence_number'])
+        return src_id
 
+    # Like update(), for a data pkt header tuple from process_pkt(...,
+    # header_only=True).
+    # The src ip string is only made the first time a src is seen.
+    def update_header(self, hdr):
+        src_ip, src_port, ts, vers, sets_count, flags, seq_num = hdr
+        raw_id = (src_ip, src_port)
+        entry = self._raw_srcs.get(raw_id)
+        if entry is None:
+            src_id = (_SRC_IPS[src_ip], src_port)
+            entry = (src_id, self._src(src_id, ts, seq_num))
+            self._raw_srcs[raw_id] = entry
+        src_id, src = entry
+        src.last_timestamp = ts
+        src.n_data_pkts += 1
+        src.n_records += sets_count
+        self._update_seq(src, seq_num)
         return src_id
 
+    # Track lost packets. Won't work if there are duplicates.
+    # gap is how many seq nums were skipped since seq_last, mod 2**32, so
+    # in order pkts and wrapping past 0xffffffff need no special cases.
+    def _update_seq(self, src, seq_num):
+        src.seq_total += 1
+        gap = (seq_num - src.seq_last - 1) & SEQ_MASK
+        if gap < SEQ_HALF:
+            src.seq_lost += gap
+            src.seq_last = seq_num
+        else:
+            # Out of order (or a duplicate). It was counted as lost when
+            # skipped over. Don't update seq_last.
+            src.seq_lost -= 1
+            src.seq_ooo += 1
+
     def print_summary_src(self, src_id):
         src = self.srcs[src_id]
-        ts_delta = src['last_timestamp'] - src['first_timestamp']
-        print '%s:%s' % (src_id[0], src_id[1])
-        print '  %s' % (' '.join(['%s=%d' % (k, src[k])
-            for k in ['n_data_pkts', 'n_records', 'n_stats_pkts']]))
+        ts_delta = src.last_timestamp - src.first_timestamp
+        print(f'{src_id[0]}:{src_id[1]}')
+        print(f'  n_data_pkts={src.n_data_pkts} n_records={src.n_records}'
+                f' n_stats_pkts={src.n_stats_pkts}')
         if ts_delta > 0:
-            print '  %s' % (' '.join(['%s/s=%.2f' % (k, src[k]/ts_delta)
-                for k in ['n_data_pkts', 'n_records', 'n_stats_pkts']]))
-        if 'stats_delta_total' in src:
-            print '  %s' % (' '.join(['%s=%d' % (x[0], x[1])
-                for x in src['stats_delta_total'].items()]))
+            print(f'  n_data_pkts/s={src.n_data_pkts/ts_delta:.2f}'
+                    f' n_records/s={src.n_records/ts_delta:.2f}'
+                    f' n_stats_pkts/s={src.n_stats_pkts/ts_delta:.2f}')
+        if src.stats_delta_total is not None:
+            print('  %s' % (' '.join('%s=%d' % x
+                for x in src.stats_delta_total.items())))
             if ts_delta > 0:
-                print '  %s' % (' '.join(['%s/s=%.2f' %
-                    (x[0], x[1]/ts_delta)
-                    for x in src['stats_delta_total'].items()]))
-        print '  %s' % (' '.join(['%s=%d' % (x[0], x[1])
-            for x in src['seq'].items()]))
+                print('  %s' % (' '.join('%s/s=%.2f' % (k, v/ts_delta)
+                    for k, v in src.stats_delta_total.items())))
+        print(f'  seq_last={src.seq_last} seq_lost={src.seq_lost}'
+                f' seq_ooo={src.seq_ooo} seq_total={src.seq_total}')
 
 
     def print_summary(self):
-        for src_id in self.srcs.iterkeys():
+        for src_id in self.srcs:
             self.print_summary_src(src_id)
 
 def parse_args():
@@ -406,6 +940,10 @@ def parse_args():
         help="show only status packets")
     p.add_argument('-S', dest='src_summary', action='store_true', 
         help="show source summaries")
+    p.add_argument('-a', dest='af_packet', action='store_true',
+        help="capture with an AF_PACKET TPACKET_V3 ring (linux, -i only)")
+    p.add_argument('-j', dest='workers', type=int, default=1,
+        help="parse pkts in this many processes")
     input_group = p.add_mutually_exclusive_group(required=True)
     input_group.add_argument('-r', dest='pcap_file')
     input_group.add_argument('-i', dest='interface')
@@ -416,6 +954,12 @@ def parse_args():
 def main(argv):
     args = parse_args()
 
+    if not sys.stdout.isatty():
+        # Output can be a line or more per pkt. Use a big buffer and flush it
+        # at checkpoints below rather than per line.
+        sys.stdout = io.open(sys.stdout.fileno(), 'w',
+                buffering=STDOUT_BUFFER_SIZE, closefd=False)
+
     pcap_filter = DEFAULT_PCAP_FILTER
     if args.extra_filter:
         pcap_filter = '(%s) and (%s)' % (DEFAULT_PCAP_FILTER, args.extra_filter)
@@ -428,35 +972,52 @@ def main(argv):
     else:
         parse_stats = False
 
+    # Source summaries only need the headers of data pkts.
+    header_only = args.src_summary and not args.stats_only
+
     if args.pcap_file:
         diter = pkt_iter(pcap_file=args.pcap_file, pcap_filter=pcap_filter,
-                stats_only=parse_stats)
+                stats_only=parse_stats, header_only=header_only,
+                workers=args.workers)
     else:
+        if args.af_packet:
+            backend = BACKEND_AF_PACKET_V3
+        else:
+            backend = BACKEND_PCAP
         diter = pkt_iter(interface=args.interface, pcap_filter=pcap_filter,
-                stats_only=parse_stats)
+                stats_only=parse_stats, header_only=header_only,
+                backend=backend, workers=args.workers)
 
     srcs = SrcTracker()
     try:
         for cnt, pkt in enumerate(diter):
-            src_id = srcs.update(pkt)
+            if type(pkt) is tuple:
+                src_id = srcs.update_header(pkt)
+            else:
+                src_id = srcs.update(pkt)
             if args.stats_only:
                 if 'stats' in pkt:
                     _print_parsed_pkt(pkt)
                     # XXX This is just printing the total so far, not since
                     # the last stats pkt.
                     srcs.print_summary_src(src_id)
+                    sys.stdout.flush()
             elif args.src_summary:
                 if cnt != 0 and cnt % 100000 == 0:
                     srcs.print_summary()
-                    print '-'*40
+                    print('-'*40)
+                    sys.stdout.flush()
             else:
                 _print_parsed_pkt(pkt)
+                if cnt % 10000 == 0:
+                    sys.stdout.flush()
     except KeyboardInterrupt:
-        print '\nSummary:'
+        print('\nSummary:')
         srcs.print_summary()
     else:
-        print '\nSummary:'
+        print('\nSummary:')
         srcs.print_summary()
+    sys.stdout.flush()
 
 if __name__ == '__main__':
     main(sys.argv)